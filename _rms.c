@@ -0,0 +1,242 @@
+/*
+ * Volume calculation for auto_record.py
+ *
+ * Computes the mean square, RMS and peak of a block of 16 bit little
+ * endian samples, the per-block hot loop of the audio recorder.
+ *
+ * The sum of squares uses AVX2 on x86 when the CPU supports it (checked
+ * at import) and NEON on little endian ARM, with a portable scalar loop
+ * as the fallback.
+ *
+ * Build:
+ *   gcc -O3 -march=native -shared -fPIC $(python3-config --includes) \
+ *       _rms.c -o _rms$(python3-config --extension-suffix)
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <math.h>
+#include <stdint.h>
+#include <stddef.h>
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#include <immintrin.h>
+#define HAVE_AVX2 1
+#endif
+
+#if defined(__ARM_NEON) && defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__
+#include <arm_neon.h>
+#define HAVE_NEON 1
+#endif
+
+#if defined(__GNUC__)
+#define unlikely(x) __builtin_expect(!!(x), 0)
+#else
+#define unlikely(x) (x)
+#endif
+
+#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__
+#define LE16(x) ((int16_t)__builtin_bswap16((uint16_t)(x)))
+#else
+#define LE16(x) (x)
+#endif
+
+/*
+ * Sum the squares of n samples.
+ * Each square fits in 31 bits, so an int64 accumulator can not overflow
+ * for any realistic block size.
+ */
+static int64_t
+sum_squares_i16_le_scalar(const int16_t *x, size_t n)
+{
+    int64_t acc = 0;
+    size_t i = 0;
+
+    /* Unrolled by 8 so the compiler can vectorize the multiply-accumulate */
+    for (; i + 8 <= n; i += 8) {
+        int32_t v0 = LE16(x[i]);
+        int32_t v1 = LE16(x[i + 1]);
+        int32_t v2 = LE16(x[i + 2]);
+        int32_t v3 = LE16(x[i + 3]);
+        int32_t v4 = LE16(x[i + 4]);
+        int32_t v5 = LE16(x[i + 5]);
+        int32_t v6 = LE16(x[i + 6]);
+        int32_t v7 = LE16(x[i + 7]);
+        acc += (int64_t)(v0 * v0) + (int64_t)(v1 * v1)
+             + (int64_t)(v2 * v2) + (int64_t)(v3 * v3)
+             + (int64_t)(v4 * v4) + (int64_t)(v5 * v5)
+             + (int64_t)(v6 * v6) + (int64_t)(v7 * v7);
+    }
+    for (; i < n; i++) {
+        int32_t v = LE16(x[i]);
+        acc += (int64_t)(v * v);
+    }
+    return acc;
+}
+
+#ifdef HAVE_AVX2
+/*
+ * AVX2 sum of squares, 16 samples per iteration.
+ * _mm256_madd_epi16 produces 8 sums of two squares. A sum can reach 2^31,
+ * which only fits as unsigned, so the sums are zero extended to 64 bits
+ * before accumulating.
+ */
+__attribute__((target("avx2")))
+static int64_t
+sum_squares_i16_le_avx2(const int16_t *x, size_t n)
+{
+    __m256i acc_lo = _mm256_setzero_si256();
+    __m256i acc_hi = _mm256_setzero_si256();
+    int64_t lanes[4];
+    int64_t acc;
+    size_t i = 0;
+
+    for (; i + 16 <= n; i += 16) {
+        __m256i v = _mm256_loadu_si256((const __m256i *)(x + i));
+        __m256i sq = _mm256_madd_epi16(v, v);
+        acc_lo = _mm256_add_epi64(acc_lo,
+                    _mm256_cvtepu32_epi64(_mm256_castsi256_si128(sq)));
+        acc_hi = _mm256_add_epi64(acc_hi,
+                    _mm256_cvtepu32_epi64(_mm256_extracti128_si256(sq, 1)));
+    }
+    _mm256_storeu_si256((__m256i *)lanes, _mm256_add_epi64(acc_lo, acc_hi));
+    acc = lanes[0] + lanes[1] + lanes[2] + lanes[3];
+
+    return acc + sum_squares_i16_le_scalar(x + i, n - i);
+}
+#endif
+
+#ifdef HAVE_NEON
+/*
+ * NEON sum of squares, 8 samples per iteration.
+ * Squares are widened to 32 bits and pairwise accumulated into 64 bits.
+ */
+static int64_t
+sum_squares_i16_le_neon(const int16_t *x, size_t n)
+{
+    int64x2_t acc = vdupq_n_s64(0);
+    size_t i = 0;
+
+    for (; i + 8 <= n; i += 8) {
+        int16x8_t v = vld1q_s16(x + i);
+        int16x4_t lo = vget_low_s16(v);
+        int16x4_t hi = vget_high_s16(v);
+        acc = vpadalq_s32(acc, vmull_s16(lo, lo));
+        acc = vpadalq_s32(acc, vmull_s16(hi, hi));
+    }
+
+    return vgetq_lane_s64(acc, 0) + vgetq_lane_s64(acc, 1)
+         + sum_squares_i16_le_scalar(x + i, n - i);
+}
+#endif
+
+/* Sum of squares implementation, selected when the module is loaded */
+#ifdef HAVE_NEON
+static int64_t (*sum_squares_i16_le)(const int16_t *, size_t) = sum_squares_i16_le_neon;
+#else
+static int64_t (*sum_squares_i16_le)(const int16_t *, size_t) = sum_squares_i16_le_scalar;
+#endif
+
+/*
+ * Mean square of a buffer of 16 bit LE samples, not normalized.
+ */
+static double
+mean_square_i16_le(const int16_t *x, size_t n)
+{
+    if (unlikely(n == 0)) {
+        return 0.0;
+    }
+    return (double)sum_squares_i16_le(x, n) / (double)n;
+}
+
+/*
+ * Largest absolute sample value in a buffer of 16 bit LE samples.
+ * Written as a simple loop the compiler can vectorize.
+ */
+static int32_t
+peak_i16_le(const int16_t *x, size_t n)
+{
+    int32_t peak = 0;
+    size_t i;
+
+    for (i = 0; i < n; i++) {
+        int32_t v = LE16(x[i]);
+        v = v < 0 ? -v : v;
+        peak = v > peak ? v : peak;
+    }
+    return peak;
+}
+
+static PyObject *
+py_mean_square_i16_le(PyObject *self, PyObject *args)
+{
+    Py_buffer buf;
+    double result;
+
+    if (!PyArg_ParseTuple(args, "y*", &buf)) {
+        return NULL;
+    }
+    result = mean_square_i16_le((const int16_t *)buf.buf, (size_t)buf.len / 2);
+    PyBuffer_Release(&buf);
+    return PyFloat_FromDouble(result);
+}
+
+static PyObject *
+py_rms_i16_le(PyObject *self, PyObject *args)
+{
+    Py_buffer buf;
+    double result;
+
+    if (!PyArg_ParseTuple(args, "y*", &buf)) {
+        return NULL;
+    }
+    result = sqrt(mean_square_i16_le((const int16_t *)buf.buf, (size_t)buf.len / 2));
+    PyBuffer_Release(&buf);
+    return PyFloat_FromDouble(result);
+}
+
+static PyObject *
+py_peak_i16_le(PyObject *self, PyObject *args)
+{
+    Py_buffer buf;
+    int32_t result;
+
+    if (!PyArg_ParseTuple(args, "y*", &buf)) {
+        return NULL;
+    }
+    result = peak_i16_le((const int16_t *)buf.buf, (size_t)buf.len / 2);
+    PyBuffer_Release(&buf);
+    return PyLong_FromLong(result);
+}
+
+static PyMethodDef rms_methods[] = {
+    {"mean_square_i16_le", py_mean_square_i16_le, METH_VARARGS,
+     "mean_square_i16_le(data) -> float\n\n"
+     "Return the mean square of a bytes-like object of 16 bit LE samples, not normalized."},
+    {"rms_i16_le", py_rms_i16_le, METH_VARARGS,
+     "rms_i16_le(data) -> float\n\n"
+     "Return the RMS of a bytes-like object of 16 bit LE samples, not normalized."},
+    {"peak_i16_le", py_peak_i16_le, METH_VARARGS,
+     "peak_i16_le(data) -> int\n\n"
+     "Return the largest absolute sample of a bytes-like object of 16 bit LE samples."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef rms_module = {
+    PyModuleDef_HEAD_INIT,
+    "_rms",
+    "Volume calculation for blocks of 16 bit audio samples.",
+    -1,
+    rms_methods
+};
+
+PyMODINIT_FUNC
+PyInit__rms(void)
+{
+#ifdef HAVE_AVX2
+    __builtin_cpu_init();
+    if (__builtin_cpu_supports("avx2")) {
+        sum_squares_i16_le = sum_squares_i16_le_avx2;
+    }
+#endif
+    return PyModule_Create(&rms_module);
+}
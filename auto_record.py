@@ -24,16 +24,34 @@ write a maximum of 1s of silence at the end of the recording
 
 import wave
 import datetime
+import functools
 import math
-import struct
 import os
-import json
 import sys
 import logging
 import logging.config
-import collections
+import threading
+from typing import Union
+import numpy as np
+import orjson
 import pyaudio
 
+# The _rms C extension (see _rms.c) and numba are optional, they speed up
+# the volume calculation for slower CPUs
+try:
+    import _rms
+except ImportError:
+    _rms = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Checking the peak of a block before its mean square only saves time when
+# both are compiled, with numpy alone the two reductions cost more.
+PEAK_CHECK = _rms is not None or numba is not None
+
 
 DATA_DIR = "data"               # Directory for output files
 RECORD_ENABLED_FILE = "record"  # File existance enables / disables recording
@@ -42,6 +60,7 @@ RATE = 8000                     # 8 KZ sampling - 8000 samples per second
 BLOCK_SIZE = 500                # Default read size - 16 blocks per second
 FORMAT = pyaudio.paInt16        # LE 16 bit, a common format
 CHANNELS = 2                    # 2 channel sterio is a comon format
+BLOCK_BYTES = BLOCK_SIZE * CHANNELS * 2 # Bytes in a block of 16 bit samples
 
 # Number of blocks of silence to trigger recording stop - 10 seconds
 SILENCE_TRIGGER_DURATION = 10 * RATE/BLOCK_SIZE  
@@ -52,25 +71,106 @@ SILENCE_WRITE_DURATION = 2 * RATE/BLOCK_SIZE
 # Number of blocks of silence to keep in listening mode - 1
 SILENCE_LISTEN_DURATION = RATE/BLOCK_SIZE    
 
+# Number of blocks held by the data buffer - covers the listening buffer
+BUFFER_CAPACITY = int(SILENCE_LISTEN_DURATION) + 4
+
+# Bytes buffered between the audio stream callback and the main loop - 2 seconds
+STREAM_BUFFER_SIZE = int(2 * RATE/BLOCK_SIZE) * BLOCK_BYTES
+
+# Number of blocks between checks of the record enabled file - 1 second
+ENABLED_CHECK_INTERVAL = RATE // BLOCK_SIZE
+
+# Bytes of recorded audio to collect before writing to the WAV file - 1 second
+WRITE_BUFFER_SIZE = RATE * CHANNELS * 2
+
+# Seconds to wait for audio data before checking the stream is still active
+READ_TIMEOUT = 1.0
+
 # Default threshold for noise/silence normalized to 1.0
 DEFAULT_NOISE_THRESHOLD=0.1    
 
 # Logging object
 logger = logging.getLogger('auto_record')
 
-def calc_rms(samples: list[float]) -> float:
+if numba is not None:
+    @numba.njit(cache=True)
+    def sum_squares_i16(shorts: np.ndarray) -> int:
+        """
+        Sum the squares of an array of 16 bit samples.
+        """
+        total = 0
+        for i in range(shorts.size):
+            value = np.int64(shorts[i])
+            total += value * value
+        return total
+
+    @numba.njit(cache=True)
+    def peak_i16(shorts: np.ndarray) -> int:
+        """
+        Return the largest absolute value in an array of 16 bit samples.
+        """
+        peak = 0
+        for i in range(shorts.size):
+            value = abs(np.int32(shorts[i]))
+            if value > peak:
+                peak = value
+        return peak
+
+
+def calc_mean_square(data: bytes) -> float:
     """
-    Calculate the amplitude of a WAVE data block
+    Calculate the mean over time of the square of the amplitude of a
+    WAVE data block of LE signed shorts.
     Normalized to 1.0
 
-    Square root of the mean over time of the square of the amplitude.
+    Comparing the mean square with a squared threshold gives the same
+    result as comparing the RMS with the threshold, without the square root.
+    """
+    if _rms is not None:
+        return _rms.mean_square_i16_le(data) / (32768.0 * 32768.0)
+
+    # View the bytes as 16 bit samples
+    shorts = np.frombuffer(data, dtype='<i2')
+    if shorts.size == 0:
+        return 0.0
+    if numba is not None:
+        sum_squares = sum_squares_i16(shorts)
+    else:
+        # Square in 64 bit to avoid overflow
+        wide = shorts.astype(np.int64)
+        sum_squares = np.dot(wide, wide)
+    return sum_squares / shorts.size / (32768.0 * 32768.0)
+
+
+def calc_peak(data: bytes) -> int:
+    """
+    Return the largest absolute sample value of a WAVE data block of
+    LE signed shorts. Not normalized.
+
+    The RMS of a block can not exceed its peak, so a block with a peak
+    below the noise threshold is silent. This is cheaper to compute than
+    the mean square.
+    """
+    if _rms is not None:
+        return _rms.peak_i16_le(data)
+
+    # View the bytes as 16 bit samples
+    shorts = np.frombuffer(data, dtype='<i2')
+    if shorts.size == 0:
+        return 0
+    if numba is not None:
+        return int(peak_i16(shorts))
+    return max(int(shorts.max()), -int(shorts.min()))
+
+
+def calc_rms(data: bytes) -> float:
     """
-    sum_squares = 0.0
-    # iterate over the block.
-    for sample in samples:
-       sum_squares += sample*sample
+    Calculate the amplitude of a WAVE data block of LE signed shorts.
+    Normalized to 1.0
 
-    return math.sqrt( sum_squares / len(samples) )
+    Square root of the mean over time of the square of the amplitude.
+    """
+    return math.sqrt(calc_mean_square(data))
 
 
 class AudioDataBlock:
@@ -78,8 +178,8 @@ class AudioDataBlock:
     Represents a block of audio data. Audio data is a set of frames, where
     each frame is a set of samples from a set of channels. 
 
-    The data is decoded into normalized samples and the volume of the data block
-    is computed for later usage.
+    The mean square of the data block is computed directly from the raw data
+    the first time it is used, the volume (RMS) is derived from it.
 
     The data is assumed to be LE signed shorts. We assume 2 samples per frame
     and read in BLOCK_SIZE frames. With BLOCK_SIZE as 1000 frames, we read 4000 bytes that encode
@@ -89,32 +189,182 @@ class AudioDataBlock:
     """
     def __init__(self, data: bytes):
         self.data : bytes = data
-        self.samples : list[float] = self.unpack_data()
-        self.volume : float = calc_rms(self.samples)
+
+    @functools.cached_property
+    def mean_square(self) -> float:
+        """
+        Mean square of the samples in the block, normalized to 1.0
+        """
+        return calc_mean_square(self.data)
+
+    @property
+    def volume(self) -> float:
+        """
+        Volume of the block, normalized to 1.0
+        """
+        return math.sqrt(self.mean_square)
 
     def is_noisy(self, threshold: float) -> bool:
         """
         Return true if volume of block meets noise threadhold.
         """
-        return self.volume >= threshold
+        return self.mean_square >= threshold * threshold
+
+
+class AudioBlockRing:
+    """
+    A fixed capacity FIFO of audio data blocks.
+
+    The data for all blocks is held in one preallocated bytearray and the
+    mean square of each block in a parallel numpy array. Slots are addressed with
+    a head index and a count, so buffering a block does not create any objects.
 
-    def unpack_data(self) -> list[float]:
+    Blocks are indexed from the oldest (0) or from the newest (-1).
+    If the ring is full, appending a block discards the oldest block.
+    """
+    def __init__(self, capacity: int, block_bytes: int = BLOCK_BYTES):
+        self.capacity = capacity
+        self.block_bytes = block_bytes
+        self.data = bytearray(capacity * block_bytes)
+        self.view = memoryview(self.data)
+        self.mean_squares = np.zeros(capacity, dtype=np.float64)
+        self.head = 0       # Slot of the oldest block
+        self.count = 0      # Number of blocks held
+
+    def __len__(self) -> int:
+        return self.count
+
+    def slot(self, index: int) -> int:
         """
-        Unpack data encoded as 2 bytes per value. 
-        Result value is a signed short int. Normalized to 1.0
+        Return the slot in the ring for a block index.
         """
-        # Convert the string of bytes into a list of 16 bit (short) samples
-        # Normalize to 1.0
-        count = len(self.data) // 2
-        format = "<%dh"%(count)
-        shorts = struct.unpack( format, self.data )
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("ring index out of range")
+        return (self.head + index) % self.capacity
+
+    def append(self, data: bytes, mean_square: float) -> None:
+        """
+        Copy a block of data into the ring with its mean square.
+        """
+        if len(data) != self.block_bytes:
+            raise ValueError("expected %d bytes, got %d" % (self.block_bytes, len(data)))
+        if self.count == self.capacity:
+            self.popleft()
+        slot = (self.head + self.count) % self.capacity
+        offset = slot * self.block_bytes
+        self.view[offset:offset + self.block_bytes] = data
+        self.mean_squares[slot] = mean_square
+        self.count += 1
+
+    def popleft(self) -> tuple[memoryview, float]:
+        """
+        Remove the oldest block and return its data and mean square.
+        The data is a view into the ring, valid until the next append.
+        """
+        slot = self.slot(0)
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
+        return self.block_data(slot), float(self.mean_squares[slot])
+
+    def truncate(self, size: int) -> None:
+        """
+        Discard the oldest blocks so no more than size blocks remain.
+        """
+        if self.count > size:
+            self.head = (self.head + self.count - size) % self.capacity
+            self.count = size
+
+    def block_data(self, slot: int) -> memoryview:
+        """
+        Return a view of the data held in a slot.
+        """
+        offset = slot * self.block_bytes
+        return self.view[offset:offset + self.block_bytes]
+
+    def recent_mean_squares(self, size: int) -> np.ndarray:
+        """
+        Return the mean squares of the newest size blocks, oldest first.
+        """
+        start = self.head + self.count - size
+        return self.mean_squares.take(np.arange(start, start + size), mode='wrap')
+
+
+class AudioStreamBuffer:
+    """
+    A ring of bytes passing audio data from the PyAudio stream callback
+    thread (the single producer) to the main loop (the single consumer).
+
+    The producer only advances write_count and the consumer only advances
+    read_count, so the data needs no lock. An event wakes the consumer when
+    data arrives. If the consumer falls behind and the ring fills, new data
+    is dropped and counted as an overrun.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.data = bytearray(capacity)
+        self.view = memoryview(self.data)
+        self.write_count = 0    # Total bytes written by the producer
+        self.read_count = 0     # Total bytes read by the consumer
+        self.overruns = 0       # Number of writes dropped because the ring was full
+        self.ready = threading.Event()
+
+    def available(self) -> int:
+        """
+        Return the number of bytes waiting to be read.
+        """
+        return self.write_count - self.read_count
+
+    def write(self, data: bytes) -> bool:
+        """
+        Copy data into the ring. Called by the producer.
+        Return False if there was no room and the data was dropped.
+        """
+        size = len(data)
+        if size > self.capacity - self.available():
+            self.overruns += 1
+            return False
+        data = memoryview(data)
+        offset = self.write_count % self.capacity
+        first = min(size, self.capacity - offset)
+        self.view[offset:offset + first] = data[:first]
+        if first < size:
+            self.view[:size - first] = data[first:]
+        self.write_count += size
+        self.ready.set()
+        return True
+
+    def wait(self, size: int, timeout: float) -> bool:
+        """
+        Wait until size bytes are available. Called by the consumer.
+        Return False if the timeout expired first.
+        """
+        while self.available() < size:
+            self.ready.clear()
+            # Check again in case data arrived before the clear
+            if self.available() >= size:
+                break
+            if not self.ready.wait(timeout):
+                return False
+        return True
+
+    def read(self, size: int) -> Union[bytes, None]:
+        """
+        Remove and return size bytes from the ring. Called by the consumer.
+        Return None if not enough data is available.
+        """
+        if self.available() < size:
+            return None
+        offset = self.read_count % self.capacity
+        first = min(size, self.capacity - offset)
+        data = bytes(self.view[offset:offset + first])
+        if first < size:
+            data += self.view[:size - first]
+        self.read_count += size
+        return data
 
-        # sample is a signed short in +/- 32768. 
-        # normalize it to 1.0
-        SHORT_NORMALIZE = (1.0/32768.0)
-        return [ float(v) * SHORT_NORMALIZE for v in shorts]
 
-    
 class AutoRecordSession:
     """
     An active audio monitoring session.
@@ -124,13 +374,20 @@ class AutoRecordSession:
         self.out_file = None                    # Open file for writing, if any
         self.open_time = None                   # datetime.datetime of recording start (within a few seconds)
         self.out_file_name = None               # Open file for writing, if any
+        self.write_buffer = bytearray()         # Audio data waiting to be written to out_file
         self.in_stream = None                   # PyAudio input stream
+        self.stream_buffer = AudioStreamBuffer(STREAM_BUFFER_SIZE) # Audio from the stream callback
+        self.overruns = 0                       # Number of stream buffer overruns reported
         self.is_recording = False               # Listening or Recording
         self.silence_count = 0                  # Count number of seqential silent blocks read
+        self.enabled = False                    # Recording enabled as of the last check
+        self.enabled_check_count = 0            # Blocks read since the last enabled check
         self.noise_threashold = DEFAULT_NOISE_THRESHOLD
+        self.noise_threshold_sq = self.noise_threashold ** 2  # Compared with block mean squares
+        self.noise_threshold_peak = self.noise_threashold * 32768.0  # Compared with block peaks
 
         # Buffered data
-        self.data_queue: collections.deque[AudioDataBlock] = collections.deque()
+        self.data_queue = AudioBlockRing(BUFFER_CAPACITY)
 
     def start_session(self, enabled: bool):
         # Ensure data directory exists
@@ -147,6 +404,8 @@ class AutoRecordSession:
             if value > 0:
                 logger.info("Setting threshold to %f" % value)
                 self.noise_threashold = value
+        self.noise_threshold_sq = self.noise_threashold ** 2
+        self.noise_threshold_peak = self.noise_threashold * 32768.0
 
         # Initialize enabled status
         path = os.path.join(DATA_DIR, RECORD_ENABLED_FILE)
@@ -159,6 +418,10 @@ class AutoRecordSession:
             except FileNotFoundError:
                 pass
 
+        # Run the volume calculations once so any compilation is done before audio arrives
+        calc_peak(bytes(BLOCK_BYTES))
+        calc_mean_square(bytes(BLOCK_BYTES))
+
         logger.info("Default device:")
         info = self.audio.get_default_input_device_info()
         logger.info(
@@ -183,7 +446,8 @@ class AutoRecordSession:
                 channels=CHANNELS,
                 rate=RATE,
                 input=True,
-                frames_per_buffer=BLOCK_SIZE)
+                frames_per_buffer=BLOCK_SIZE,
+                stream_callback=self.on_audio)
         logger.info("Audio stream open")
 
     def cleanup_session(self):
@@ -202,25 +466,33 @@ class AutoRecordSession:
         Runs listening and recording functions.
         """
         self.start_session(enabled)
+        self.enabled = self.check_recording_enabled()
         try:
-            while self.in_stream is not None:
+            while self.in_stream is not None and self.in_stream.is_active():
                 # Read a block of audio
-                data = self.in_stream.read(BLOCK_SIZE)
+                data = self.read_block()
+                if data is None:
+                    continue
+
+                # The enabled setting changes rarely, check it about once a second
+                self.enabled_check_count += 1
+                if self.enabled_check_count >= ENABLED_CHECK_INTERVAL:
+                    self.enabled_check_count = 0
+                    self.enabled = self.check_recording_enabled()
 
                 # if we are not enabled for recording, ensure any
                 # in process recording is completed and the buffer is empty
-                if not self.check_recording_enabled():
+                if not self.enabled:
                     continue
 
-                # Buffer data if we are enabled for recording.
-                block = AudioDataBlock(data)
-                self.data_queue.append(block)
-
                 # Run listening and recording logic
+                mean_square = self.block_mean_square(data)
                 if not self.is_recording:
+                    # Buffer data while listening, it is written if recording starts
+                    self.data_queue.append(data, mean_square)
                     self.run_listen_logic()
-                elif self.is_recording:
-                    self.run_record_logic()
+                else:
+                    self.run_record_logic(data, mean_square)
 
         except KeyboardInterrupt:
             # Interupted, complete current recording
@@ -228,6 +500,37 @@ class AutoRecordSession:
                 self.stop_recording()
         self.cleanup_session()
 
+    def on_audio(self, in_data: bytes, frame_count: int, time_info: dict, status: int):
+        """
+        PyAudio stream callback, run on the audio thread.
+        Queue the data for the main loop and return immediately.
+        """
+        self.stream_buffer.write(in_data)
+        return (None, pyaudio.paContinue)
+
+    def read_block(self) -> Union[bytes, None]:
+        """
+        Wait for the next block of audio from the stream callback.
+        Return None if no block arrived within the read timeout.
+        """
+        if self.stream_buffer.overruns != self.overruns:
+            logger.warning("Audio data dropped, %d buffer overruns" %
+                           (self.stream_buffer.overruns - self.overruns))
+            self.overruns = self.stream_buffer.overruns
+        if not self.stream_buffer.wait(BLOCK_BYTES, READ_TIMEOUT):
+            return None
+        return self.stream_buffer.read(BLOCK_BYTES)
+
+    def block_mean_square(self, data: bytes) -> float:
+        """
+        Return the mean square of a block for the noise checks.
+        A block with a peak below the noise threshold is silent, so
+        0.0 is returned without calculating the mean square.
+        """
+        if PEAK_CHECK and calc_peak(data) < self.noise_threshold_peak:
+            return 0.0
+        return calc_mean_square(data)
+
     def start_recording(self) -> None:
         """
         Start the recording session, change to recording mode
@@ -237,6 +540,11 @@ class AutoRecordSession:
         self.ensure_open_file()
         self.report_status("start recording")
 
+        # Record the data buffered while listening
+        while len(self.data_queue) > 0 and self.is_recording:
+            data, mean_square = self.data_queue.popleft()
+            self.run_record_logic(data, mean_square)
+
     def stop_recording(self) -> None:
         """
         Complete the recording, change to listen mode
@@ -244,8 +552,7 @@ class AutoRecordSession:
         self.is_recording = False
         self.ensure_close_file()
         # Ensure no extra data is buffered
-        while len(self.data_queue) > SILENCE_LISTEN_DURATION:
-            self.data_queue.popleft()
+        self.data_queue.truncate(int(SILENCE_LISTEN_DURATION))
 
     def run_listen_logic(self) -> None:
         """
@@ -259,49 +566,44 @@ class AutoRecordSession:
         # Check for 2 of 3 noisy frames
         if len(self.data_queue) > 2:
             # Check if noise threashold exceeded
-            count = 0
-            for index in range(-1, -4, -1):
-                if self.data_queue[index].is_noisy(self.noise_threashold):
-                    count += 1
-            if count >= 2:
+            mean_squares = self.data_queue.recent_mean_squares(3)
+            if np.count_nonzero(mean_squares >= self.noise_threshold_sq) >= 2:
                 # Trigger recording
                 self.start_recording()
 
         # Discard frames that will never be recorded
         if not self.is_recording:
-            while len(self.data_queue) > SILENCE_LISTEN_DURATION:
-                self.data_queue.popleft()
+            self.data_queue.truncate(int(SILENCE_LISTEN_DURATION))
 
-    def run_record_logic(self) -> None:
+    def run_record_logic(self, data: bytes, mean_square: float) -> None:
         """
-        Detect write pause and end of recording.
+        Record a block, detect write pause and end of recording.
         
         Use the count of silent blocks to set / clear silence pause
         and potentially change the mode to LISTEN
 
         Assumed: mode == RECORD
         """
-        while len(self.data_queue) > 0:
-            block = self.data_queue.popleft()
-
-            # Count consective silent frames
-            if block.is_noisy(self.noise_threashold):
-                logger.debug("found noise: %f" % block.volume)
-                self.silence_count = 0
-            else:
-                self.silence_count += 1
-
-            # Write buffer if we have not seen the limit of silent frames.
-            if self.silence_count < SILENCE_WRITE_DURATION:
-                # Write buffer
-                if self.out_file is not None:
-                    self.out_file.writeframes(block.data)
-
-            # Stop recoording if we have exceeded the wait duration for more noise
-            if self.silence_count > SILENCE_TRIGGER_DURATION:
-                # Long silence, stop recording
-                self.stop_recording()
-                self.report_status("stopped recording due to silence")
+        # Count consective silent frames
+        if mean_square >= self.noise_threshold_sq:
+            logger.debug("found noise: %f" % math.sqrt(mean_square))
+            self.silence_count = 0
+        else:
+            self.silence_count += 1
+
+        # Write buffer if we have not seen the limit of silent frames.
+        if self.silence_count < SILENCE_WRITE_DURATION:
+            # Write buffer
+            if self.out_file is not None:
+                self.write_buffer += data
+                if len(self.write_buffer) >= WRITE_BUFFER_SIZE:
+                    self.flush_write_buffer()
+
+        # Stop recoording if we have exceeded the wait duration for more noise
+        if self.silence_count > SILENCE_TRIGGER_DURATION:
+            # Long silence, stop recording
+            self.stop_recording()
+            self.report_status("stopped recording due to silence")
 
     def check_recording_enabled(self) -> bool:
         """
@@ -343,6 +645,14 @@ class AutoRecordSession:
         self.out_file.setsampwidth(self.audio.get_sample_size(FORMAT))
         self.out_file.setframerate(RATE)
 
+    def flush_write_buffer(self) -> None:
+        """
+        Write any buffered audio data to the output WAV file.
+        """
+        if self.out_file is not None and len(self.write_buffer) > 0:
+            self.out_file.writeframes(self.write_buffer)
+        self.write_buffer.clear()
+
     def ensure_close_file(self) -> None:
         """
         Close the output WAV file and write information in a json file.
@@ -352,6 +662,7 @@ class AutoRecordSession:
             return
 
         # Close file
+        self.flush_write_buffer()
         self.out_file.close()
 
         # Rename file and create a meta file to document it
@@ -376,8 +687,8 @@ class AutoRecordSession:
         # Capture files that are 2 seconds or longer
         if recording_length >= 2:
             os.rename(path_tmp, path_wav)
-            with open(path_json, 'w') as file:
-                file.write(json.dumps(info))
+            with open(path_json, 'wb') as file:
+                file.write(orjson.dumps(info))
         else:
             os.remove(path_tmp)
 
@@ -415,7 +726,9 @@ class AutoRecordSession:
             print("Establishing a baseline...")
             while self.in_stream is not None and state != DONE:
                 # Read a block 
-                data = self.in_stream.read(BLOCK_SIZE)
+                data = self.read_block()
+                if data is None:
+                    continue
                 block = AudioDataBlock(data)
 
                 # Process audio block accordin to the curren state
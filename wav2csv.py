@@ -1,15 +1,21 @@
 """
-Connvert of data in a WAV file to a CSV file.
+Connvert of data in a WAV file to a CSV file or a numpy .npy file.
 """
 
-import sys
-import struct
+import argparse
 import wave
 import numpy as np
 import matplotlib.pyplot as plt
 
 import auto_record
 
+# pyarrow is optional, it writes CSV files much faster than np.savetxt
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+
 def convert(filename: str) -> np.ndarray:
     """
     Read filename as a WAVE file, return a normalized numpy array
@@ -17,17 +23,11 @@ def convert(filename: str) -> np.ndarray:
     with wave.open(filename, 'rb') as wf:
         # Assume we have 16bit 
         channels = wf.getnchannels()
-        values = []
-
-        while len(data := wf.readframes(1000)) > 0:
-            count = len(data) // 2
-            fmt = "<%dh" % (count)      # 16 bit Little Endian
-            shorts = struct.unpack(fmt, data)
-            values.extend(shorts)
+        data = wf.readframes(wf.getnframes())
 
-    result = np.array(values, dtype=int)
-    result = np.reshape(result, (-1, channels))
-    return result
+    # 16 bit Little Endian, copied so the result is writable
+    result = np.frombuffer(data, dtype='<i2').reshape(-1, channels)
+    return result.copy()
 
 def read_data_blocks(filename: str) -> list[auto_record.AudioDataBlock]:
     result = []
@@ -42,10 +42,27 @@ def get_volume_array(blocks: list[auto_record.AudioDataBlock]) -> np.ndarray:
 
 def write_array(filename: str, array: np.ndarray) -> None:
     """
-    Use np.savetxt to write the array to a CSV file
+    Write the array to a CSV file, one column per channel.
+    Use pyarrow if available, otherwise np.savetxt
+    """
+    print(f"Write file: {filename}")
+    array = np.reshape(array, (len(array), -1))
+    if pa is not None:
+        table = pa.table({f"ch{i}": np.ascontiguousarray(array[:, i])
+                          for i in range(array.shape[1])})
+        pacsv.write_csv(table, filename,
+                        write_options=pacsv.WriteOptions(include_header=False))
+    else:
+        fmt = "%d" if np.issubdtype(array.dtype, np.integer) else "%.18e"
+        np.savetxt(filename, array, delimiter=",", fmt=fmt)
+    print("Done")
+
+def write_npy(filename: str, array: np.ndarray) -> None:
+    """
+    Use np.save to write the array to a binary .npy file
     """
-    print(f"Write file: {filename_csv}")
-    np.savetxt(filename_csv, array, delimiter=",")
+    print(f"Write file: {filename}")
+    np.save(filename, array)
     print("Done")
 
 def plot_array(array: np.ndarray) -> None:
@@ -77,14 +94,19 @@ def normalize(array: np.ndarray) -> np.ndarray:
 
 if __name__ == '__main__':
     """
-    Read a wave file and write a CSV
+    Read a wave file and write a CSV or npy file
     """
-    if len(sys.argv) != 2:
-        print(f"usage: {sys.argv[0]} <wav file>")
-        sys.exit(-1)
-    filename = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Convert a WAVE file to a CSV or npy file")
+    parser.add_argument("filename", help="WAVE file to convert")
+    parser.add_argument("--format", choices=["csv", "npy"], default="csv",
+                        help="output file format (default: csv)")
+    args = parser.parse_args()
+    filename = args.filename
     array = convert(filename)
-    filename_csv = f"{filename}.csv"
-    write_array(filename_csv, array)
+    if args.format == "npy":
+        write_npy(f"{filename}.npy", array)
+    else:
+        filename_csv = f"{filename}.csv"
+        write_array(filename_csv, array)
 
 
@@ -7,7 +7,6 @@ A simple fast-api based web server to serve audio files.
   * A button to toggel recording enabled
 """
 import datetime
-import json
 import logging
 import logging.handlers
 import os
@@ -15,9 +14,10 @@ from typing import Annotated
 from typing import Any, Tuple, Union
 
 from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, Response, RedirectResponse
+from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+import orjson
 import uvicorn
 
 import auto_record
@@ -25,28 +25,49 @@ import auto_record
 # Initialize fast api and logging
 app = FastAPI()
 templates = Jinja2Templates(directory=".")
+main_template = templates.get_template("main.html")   # Compiled once at startup
 logger = logging.getLogger("uvicorn.error")
 
+# Path of the file that enables recording when it exists
+RECORD_ENABLED_PATH = os.path.join(auto_record.DATA_DIR, auto_record.RECORD_ENABLED_FILE)
+
+# File list from the last read of the data directory.
+# Replaced as a whole so request threads always see a consistent set.
+file_list_cache = {"mtime": None, "entries": [], "by_basename": {}}
+
+# Rendered main page, reused while the file list and recording setting are unchanged.
+page_cache = {"entries": None, "recording": None, "html": ""}
+
 
 def get_file_list():
     """
     Read the contents of the JSON information files in the data directory
     and return list of dictionary elements sorted by the timestamp.
+
+    The list is cached until the data directory is modified.
     """
+    global file_list_cache
+    # Stat before reading so a change made during the read is seen next time
+    mtime = os.stat(auto_record.DATA_DIR).st_mtime_ns
+    cache = file_list_cache
+    if mtime == cache["mtime"]:
+        return cache["entries"]
+
     result = []
     logger.debug("get file list")
-    entries = os.listdir(auto_record.DATA_DIR)
-    for entry in entries:
-        if entry.endswith(".json"):
-            path = os.path.join(auto_record.DATA_DIR, entry)
-            f = open(path, 'r')
-            info = json.loads(f.read())
-            f.close()
-
-            # Change timestamp from text to datetime.dateime
-            info["timestamp"] = datetime.datetime.fromisoformat(info["timestamp"])
-            result.append(info)
+    with os.scandir(auto_record.DATA_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith(".json"):
+                with open(entry.path, 'rb') as f:
+                    info = orjson.loads(f.read())
+
+                # Change timestamp from text to datetime.dateime
+                info["timestamp"] = datetime.datetime.fromisoformat(info["timestamp"])
+                result.append(info)
     result.sort(key=lambda e: e["timestamp"], reverse=True)
+    file_list_cache = {"mtime": mtime,
+                       "entries": result,
+                       "by_basename": {e["basename"]: e for e in result}}
     return result
 
 def lookup_file(basename: str) -> Union[dict[str, Any], None]:
@@ -54,30 +75,26 @@ def lookup_file(basename: str) -> Union[dict[str, Any], None]:
     Find a wav file for basename, return the wav filename
     Return None if not found
     """
-    for entry in get_file_list():
-        if entry["basename"] == basename:
-            return entry
-    return None
+    get_file_list()
+    return file_list_cache["by_basename"].get(basename)
 
 
 def get_record_setting() -> bool: 
     """
     Return TRUE if recording
     """
-    path = os.path.join(auto_record.DATA_DIR, auto_record.RECORD_ENABLED_FILE)
-    return os.path.isfile(path)
+    return os.path.isfile(RECORD_ENABLED_PATH)
 
 def set_record_setting(recording: bool):
     """
     Set the recording status
     """
-    path = os.path.join(auto_record.DATA_DIR, auto_record.RECORD_ENABLED_FILE)
     if recording:
-        f = open(path, 'w')
+        f = open(RECORD_ENABLED_PATH, 'w')
         f.close()
     else:
-        if os.path.isfile(path):
-            os.remove(path)
+        if os.path.isfile(RECORD_ENABLED_PATH):
+            os.remove(RECORD_ENABLED_PATH)
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -86,25 +103,34 @@ def main_page(request: Request):
     Serve root page using main.html
     List of recordings
     """
+    global page_cache
     recording = get_record_setting()
     entries = get_file_list()
-    return templates.TemplateResponse(
-        request=request, name="main.html", 
-        context={"entries": entries,
-                 "recording": recording}
-    )
-
-@app.get("/file/{filename}", response_class=HTMLResponse)
+    # A new file list is a new list object, so identity detects changes
+    cache = page_cache
+    if cache["entries"] is not entries or cache["recording"] != recording:
+        html = main_template.render(entries=entries, recording=recording)
+        cache = {"entries": entries, "recording": recording, "html": html}
+        page_cache = cache
+    return HTMLResponse(cache["html"])
+
+@app.get("/file/{filename}", response_class=FileResponse)
 def read_file(filename, request: Request):
     """
-    Serve a specific recording file
+    Serve a specific recording file.
+    The file is streamed rather than read into memory, and HTTP Range
+    requests are supported so the browser can seek without downloading
+    the whole recording.
     """
     entry = lookup_file(filename)
     if entry is not None:
         path = os.path.join(auto_record.DATA_DIR, entry["sound_file"])
-        with open(path, 'rb') as file:
-            data = file.read()
-            return Response(content=data, media_type='audio/wav')
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404)
+        return FileResponse(path, media_type='audio/wav', filename=entry["sound_file"],
+                            stat_result=stat_result)
     raise HTTPException(status_code=404)
 
 @app.post("/", response_class=RedirectResponse)